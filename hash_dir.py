@@ -1,33 +1,384 @@
 import os
 import hashlib
 import csv
-import sys
+import re
+import base64
+import stat
+import argparse
+import queue
+import threading
+import itertools
+import multiprocessing
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def hash_file(filename):
+# Read size for hashing large files. Reading h.block_size (128 bytes) at a
+# time spends most of the run in Python call overhead rather than in the hash
+# itself. It also keeps every update well above the size at which hashlib
+# releases the GIL, so hashing threads run in parallel. Each worker thread
+# keeps RING_SLABS of these, so it is also what bounds memory per worker.
+SLAB_SIZE = 8 * 1024 * 1024
+
+# Files up to SMALL_MAX_SIZE are hashed from a single read. Files up to
+# MEDIUM_MAX_SIZE take at most a few SLAB_SIZE reads on the calling thread;
+# larger ones are read ahead on a separate thread (see _hash_big).
+SMALL_MAX_SIZE = 4096
+MEDIUM_MAX_SIZE = 64 * 1024 * 1024
+
+# Files below this size are sent to worker processes in batches, since
+# hashing one takes about as long as the round-trip to the worker. Larger
+# files are sent one at a time so they stay spread across workers.
+BATCH_MAX_SIZE = 1024 * 1024
+
+# Number of SLAB_SIZE slabs a file above MEDIUM_MAX_SIZE is read through.
+# A reader thread fills free slabs while the hashing thread works through
+# filled ones, so reading and hashing the same file overlap.
+RING_SLABS = 3
+
+# Tasks queued per worker thread. executor.map would create a Future for
+# every file up front; this keeps only a few per worker in flight.
+TASKS_PER_THREAD = 4
+
+DIGEST_SIZE = hashlib.blake2b().digest_size
+_NO_DIGEST = bytes(DIGEST_SIZE)
+
+# Ways to write a digest in the hash column. base64 takes 88 characters per
+# digest against 128 for hex, which shrinks the CSV for large trees.
+DIGEST_ENCODINGS = {
+    'hex': lambda digest: digest.hex(),
+    'base64': lambda digest: base64.b64encode(digest).decode('ascii'),
+}
+
+# File paths and sizes from the scan, indexed by position. Set once per
+# worker process by _init_worker(), so tasks only carry an integer index.
+_PATHS = []
+_SIZES = []
+
+# Read size for files up to SMALL_MAX_SIZE. Anything that fills it has grown
+# since the scan and is hashed as a big file instead.
+SMALL_BUFFER_SIZE = 64 * 1024
+
+# Each thread reuses its own buffers so data is read straight into the same
+# memory instead of allocating (and zero-filling) new buffers per file.
+_local = threading.local()
+
+def _get_buffer():
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        buffer = _local.buffer = bytearray(SMALL_BUFFER_SIZE)
+        _local.view = memoryview(buffer)
+    return buffer, _local.view
+
+def _get_slabs(count):
+    # Slabs are only allocated once a thread needs them: one for medium
+    # files, RING_SLABS once it meets a big file.
+    slabs = getattr(_local, 'slabs', None)
+    if slabs is None:
+        slabs = _local.slabs = []
+    while len(slabs) < count:
+        slabs.append(bytearray(SLAB_SIZE))
+    return slabs[:count]
+
+def _fadvise(fd, advice, offset=0, length=0):
+    # posix_fadvise is only a hint, and does not exist on Windows or macOS.
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+if hasattr(os, 'readv'):
+    def _readinto(fd, buffer):
+        return os.readv(fd, [buffer])
+else:
+    # No readv on Windows; FileIO.readinto also reads straight into buffer.
+    def _readinto(fd, buffer):
+        with open(fd, 'rb', buffering=0, closefd=False) as file:
+            return file.readinto(buffer)
+
+# hash_file picks one of the three functions below by file size, so each
+# size class runs a straight-line path with no per-call branching inside.
+# The size only picks the strategy; each of them reads to EOF.
+
+def _hash_small(fd):
+    # One read covers the whole file, and the hint syscalls would cost more
+    # than they save.
+    buffer, view = _get_buffer()
+    n = _readinto(fd, buffer)
+    if n == len(buffer):
+        # The file has grown far past its scanned size.
+        os.lseek(fd, 0, os.SEEK_SET)
+        return _hash_big(fd)
+    return hashlib.blake2b(view[:n]).digest()
+
+def _hash_medium(fd):
+    # Plain reads rather than mmap: if a mapped file is truncated, touching
+    # the lost pages raises SIGBUS, which kills the whole process. With
+    # SLAB_SIZE reads this loop runs at most a few times per file.
+    _fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+    slab = _get_slabs(1)[0]
+    view = memoryview(slab)
     h = hashlib.blake2b()
-    with open(filename, 'rb') as file:
+    while True:
+        n = _readinto(fd, slab)
+        if not n:
+            break
+        h.update(view[:n])
+    _fadvise(fd, 'POSIX_FADV_DONTNEED')
+    return h.digest()
+
+def _read_slabs(fd, free, filled):
+    # Reader side of _hash_big. Puts (slab, n) on filled for each read,
+    # ending with n == 0, or the exception if anything fails. Every way out
+    # puts something, or _hash_big would wait on filled forever.
+    offset = 0
+    try:
         while True:
-            chunk = file.read(h.block_size)
-            if not chunk:
+            slab = free.get()
+            n = _readinto(fd, slab)
+            filled.put((slab, n))
+            if not n:
+                return
+            offset += n
+            # Have the kernel fetch the next chunk while this one is hashed.
+            _fadvise(fd, 'POSIX_FADV_WILLNEED', offset, SLAB_SIZE)
+    except BaseException as e:
+        filled.put(e)
+
+def _hash_big(fd):
+    # Ask for a larger readahead window, and drop the file from the page
+    # cache once hashed so a large tree does not push out everything else.
+    _fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+    free = queue.Queue()
+    filled = queue.Queue()
+    for slab in _get_slabs(RING_SLABS):
+        free.put(slab)
+    # readv and blake2b.update both release the GIL on slabs this size, so
+    # the reader thread and this one really do run at the same time.
+    reader = threading.Thread(target=_read_slabs, args=(fd, free, filled), daemon=True)
+    reader.start()
+    h = hashlib.blake2b()
+    try:
+        while True:
+            item = filled.get()
+            if isinstance(item, BaseException):
+                raise item
+            slab, n = item
+            if not n:
                 break
-            h.update(chunk)
-    return h.hexdigest()
+            h.update(memoryview(slab)[:n])
+            free.put(slab)
+    finally:
+        # The reader has stopped by now: it has put its last item and the
+        # descriptor can be closed.
+        reader.join()
+    _fadvise(fd, 'POSIX_FADV_DONTNEED')
+    return h.digest()
 
-def hash_directory(directory, output_file):
-    with open(output_file, 'w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow(["File Path", "BLAKE2 Hash"])
-        for root, dirs, files in os.walk(directory):
-            for name in files:
-                file_path = os.path.join(root, name)
+def hash_file(filename, known_size=None):
+    fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        file_size = known_size if known_size is not None else os.fstat(fd).st_size
+        if file_size <= SMALL_MAX_SIZE:
+            return _hash_small(fd)
+        if file_size <= MEDIUM_MAX_SIZE:
+            return _hash_medium(fd)
+        return _hash_big(fd)
+    finally:
+        os.close(fd)
+
+def _init_worker(paths, sizes):
+    global _PATHS, _SIZES
+    _PATHS = paths
+    _SIZES = sizes
+
+def _try_hash(file_path, file_size=None):
+    # Errors go back to the main process as text rather than being printed
+    # here, so they are reported once, together, at the end of the run.
+    try:
+        return hash_file(file_path, file_size), None
+    except (IOError, PermissionError) as e:
+        return None, str(e)
+
+def worker(idx):
+    return (idx, *_try_hash(_PATHS[idx], _SIZES[idx]))
+
+def scan_directory(directory, errors):
+    """Yield (path, stat_result) for every file under directory, in os.walk order.
+
+    The stat comes from the DirEntry, so each file costs one stat() at most
+    and directories are told apart from files without any extra syscall.
+    Entries that cannot be read are skipped and their errors appended to
+    errors.
+    """
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
                 try:
-                    file_hash = hash_file(file_path)
-                    writer.writerow([file_path, file_hash])
-                except (IOError, PermissionError):
-                    print(f"Error processing {name}")
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    st = entry.stat()
+                except OSError as e:
+                    errors.append(str(e))
+                    continue
+                yield entry.path, st
+    except OSError as e:
+        errors.append(str(e))
+    for subdir in subdirs:
+        yield from scan_directory(subdir, errors)
 
-if len(sys.argv) != 2:
-    print("Usage: python script.py directory_path")
-else:
-    directory = sys.argv[1]
-    hash_directory(directory, 'dir_hashes_blake2.csv')
+def hash_directory(directory, output_file, num_workers=None, use_processes=False,
+                   digest_encoding='hex'):
+    # Per-file state is kept in parallel arrays rather than per-file objects:
+    # digests holds DIGEST_SIZE bytes for each file, and done flags the files
+    # whose result is in.
+    paths = []
+    sizes = array('q')
+    digests = bytearray()
+    done = bytearray()
+    to_hash = []
+    # Empty files and extra hard links to a file already in the list are not
+    # sent to the workers. Empty files are hashed right here; a hard link is
+    # given the digest of the first path seen for its inode.
+    first_link = {}
+    copies = {}
+    errors = []
+    for file_path, st in scan_directory(directory, errors):
+        idx = len(paths)
+        paths.append(file_path)
+        sizes.append(st.st_size)
+        digest = None
+        if st.st_size == 0 and stat.S_ISREG(st.st_mode):
+            # FIFOs and devices also report a size of 0, so only regular files
+            # take this shortcut. Even those are read rather than assumed
+            # empty: procfs files are regular, report 0 and still have
+            # content. One short read costs less than a round-trip to a worker.
+            try:
+                digest = hash_file(file_path, 0)
+            except OSError:
+                pass
+        digests += _NO_DIGEST if digest is None else digest
+        done.append(digest is not None)
+        if digest is not None:
+            continue
+        # st_nlink is always 0 from scandir on Windows, so this never matches there.
+        if st.st_nlink > 1:
+            first = first_link.setdefault((st.st_dev, st.st_ino), idx)
+            if first != idx:
+                copies.setdefault(first, []).append(idx)
+                continue
+        to_hash.append(idx)
+    # Dispatch the largest files first (LPT scheduling), so one big file does
+    # not start last and leave the other workers idle while it finishes.
+    order = sorted(to_hash, key=sizes.__getitem__, reverse=True)
+
+    num_workers = num_workers or os.cpu_count()
+    with open(output_file, 'w', newline='', encoding='utf-8') as file:
+        if digest_encoding == 'hex':
+            file.write("File Path,BLAKE2 Hash\r\n")
+        else:
+            file.write(f"File Path,BLAKE2 Hash ({digest_encoding})\r\n")
+        encode = DIGEST_ENCODINGS[digest_encoding]
+        if use_processes:
+            split = next((i for i, idx in enumerate(order) if sizes[idx] < BATCH_MAX_SIZE), len(order))
+            large, small = order[:split], order[split:]
+            chunksize = max(1, len(small) // (num_workers * 16))
+            with multiprocessing.Pool(processes=num_workers, initializer=_init_worker,
+                                      initargs=(paths, sizes)) as pool:
+                # Both calls queue their tasks straight away; large files go first.
+                large_results = pool.imap_unordered(worker, large)
+                small_results = pool.imap_unordered(worker, small, chunksize=chunksize)
+                results = itertools.chain(large_results, small_results)
+                _write_results(file, paths, results, digests, done, copies, encode, errors)
+        else:
+            _init_worker(paths, sizes)
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = _map_bounded(executor, worker, order, num_workers * TASKS_PER_THREAD)
+                _write_results(file, paths, results, digests, done, copies, encode, errors)
+
+    if errors:
+        print(f"Skipped {len(errors)} path(s) that could not be read:")
+        for message in errors[:10]:
+            print(f"  {message}")
+        if len(errors) > 10:
+            print(f"  ... and {len(errors) - 10} more")
+
+def _map_bounded(executor, fn, items, limit):
+    """Yield fn(item) for each item, in completion order.
+
+    At most limit tasks are submitted at a time, and a new one is submitted
+    as each finishes, so memory does not grow with the number of items.
+    """
+    items = iter(items)
+    pending = {executor.submit(fn, item) for item in itertools.islice(items, limit)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            for item in itertools.islice(items, 1):
+                pending.add(executor.submit(fn, item))
+            yield future.result()
+
+# Paths containing any of these need csv quoting; anything else is written as is.
+_needs_quoting = re.compile(r'[,"\r\n]').search
+
+def _write_results(file, paths, results, digests, done, copies, encode, errors):
+    """Write rows in path order as results arrive in any order.
+
+    Each digest is copied into its file's slot in digests and flagged in
+    done, along with any hard links to it listed in copies. If the file
+    failed, each of those links is hashed on its own instead, so it gets its
+    own row or its own error. Then every row up
+    to the first file still being hashed is written. Rows are the same as
+    csv.writer would produce, but only paths that need quoting go through it.
+    encode turns a digest into the text of the hash column. Files that failed
+    are left out and their errors appended to errors.
+    """
+    writer = csv.writer(file)
+    view = memoryview(digests)
+    failed = {}
+    next_idx = 0
+    # The trailing None writes the rows when nothing needed hashing at all.
+    for result in itertools.chain(results, [None]):
+        if result is not None:
+            idx, digest, error = result
+            updates = [(idx, digest, error)]
+            for i in copies.get(idx, ()):
+                if digest is None:
+                    # Rare enough to do here rather than go back to the pool.
+                    updates.append((i, *_try_hash(paths[i])))
+                else:
+                    updates.append((i, digest, None))
+            for i, digest, error in updates:
+                if digest is None:
+                    failed[i] = error
+                else:
+                    view[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] = digest
+                done[i] = 1
+        while next_idx < len(done) and done[next_idx]:
+            idx = next_idx
+            next_idx += 1
+            file_path = paths[idx]
+            if idx in failed:
+                errors.append(failed.pop(idx))
+                continue
+            file_hash = encode(view[idx * DIGEST_SIZE:(idx + 1) * DIGEST_SIZE])
+            if _needs_quoting(file_path):
+                writer.writerow([file_path, file_hash])
+            else:
+                file.write(f"{file_path},{file_hash}\r\n")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute the BLAKE2 hash of every file in a directory.")
+    parser.add_argument('directory')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="number of files hashed at once (default: CPU count)")
+    parser.add_argument('--procs', action='store_true',
+                        help="hash in worker processes instead of threads")
+    parser.add_argument('--digest-encoding', choices=sorted(DIGEST_ENCODINGS), default='hex',
+                        help="how to write each hash in the CSV (default: hex)")
+    args = parser.parse_args()
+    hash_directory(args.directory, 'dir_hashes_blake2.csv', args.workers, args.procs,
+                   args.digest_encoding)